@@ -14,15 +14,40 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import io
+import os
 import sys
+import csv
+import json
+import math
+import errno
+import pickle
+import shlex
+import hashlib
 import argparse
 import logging
 import inspect
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 __all__ = ['ArgumentHandler','LOG_LEVEL','subcmd','reset_registered_subcommands']
 
 LOG_LEVEL = 'log_level'
 
+logger = logging.getLogger(__name__)
+
+PY2 = sys.version_info[0] == 2
+
+try:
+    string_types = basestring
+    text_type = unicode
+except NameError:
+    string_types = str
+    text_type = str
+
 LOG_LEVEL_STR_LOOKUP = {logging.DEBUG:'DEBUG', logging.INFO:'INFO',
                         logging.WARNING:'WARNING', logging.ERROR:'ERROR',
                         logging.CRITICAL:'CRITICAL'}
@@ -33,15 +58,328 @@ def default_log_config(level,args):
     """
     logging.basicConfig(level=level)
 
+#################################
+# config file handling
+#################################
+TRUE_STRS = ('1','true','yes','on')
+FALSE_STRS = ('0','false','no','off','')
+
+parsed_config_cache = {}
+
+def parse_config_file(path):
+    """
+    Parse a config file into a dict.  Files ending in `.toml` are read as TOML,
+    everything else is read as JSON.
+    """
+    if path.endswith('.toml'):
+        try:
+            import tomllib as toml_parser
+        except ImportError:
+            try:
+                import tomli as toml_parser
+            except ImportError:
+                raise ImportError('reading TOML config file %s requires python 3.11+ or the tomli package' % path)
+
+        with open(path,'rb') as fh:
+            contents = toml_parser.load(fh)
+    else:
+        with open(path,'r') as fh:
+            contents = json.load(fh)
+
+    if type(contents) is not dict:
+        raise ValueError('config file %s must contain a table of argument values' % path)
+
+    return contents
+
+def load_config_file(path,cache_dir=None):
+    """
+    Return the parsed contents of the config file at `path` or None if it
+    doesn't exist.
+
+    Parsed contents are kept in memory and, if `cache_dir` is given, pickled
+    into that directory.  Both are keyed by the path, mtime and size of the
+    file so a cached copy is only used until the file changes.
+    """
+    path = os.path.abspath(path)
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    key = (path,st.st_mtime,st.st_size)
+
+    if key in parsed_config_cache:
+        return parsed_config_cache[key]
+
+    cache_fname = None
+    if cache_dir:
+        cache_fname = os.path.join(cache_dir,'%s.pickle' % hashlib.sha1(path.encode('utf-8')).hexdigest())
+
+        try:
+            with open(cache_fname,'rb') as fh:
+                cached_key, contents = pickle.load(fh)
+            if cached_key == key:
+                parsed_config_cache[key] = contents
+                return contents
+        except Exception:
+            # a missing or unreadable cache entry just means we parse the file
+            pass
+
+    contents = parse_config_file(path)
+    parsed_config_cache[key] = contents
+
+    if cache_fname:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_fname = '%s.%d.tmp' % (cache_fname,os.getpid())
+            with open(tmp_fname,'wb') as fh:
+                pickle.dump((key,contents),fh,pickle.HIGHEST_PROTOCOL)
+            replace_file(tmp_fname,cache_fname)
+        except (OSError,IOError,pickle.PicklingError):
+            # the cache is only an optimization
+            pass
+
+    return contents
+
+#################################
+# incremental execution
+#################################
+def path_signature(path,change_detection):
+    """
+    Return a JSON-serializable signature of the file or directory at `path`,
+    or None if it doesn't exist.  With `change_detection` set to 'mtime',
+    this is based on modification times and sizes; with 'hash' it is based on
+    the file contents.  Directories are signed by all files beneath them.
+    """
+    if os.path.isdir(path):
+        signatures = []
+        for dirpath,dirnames,filenames in os.walk(path):
+            dirnames.sort()
+            for fname in sorted(filenames):
+                fpath = os.path.join(dirpath,fname)
+                signatures.append([os.path.relpath(fpath,path),path_signature(fpath,change_detection)])
+        return signatures
+
+    if change_detection == 'hash':
+        try:
+            h = hashlib.sha1()
+            with open(path,'rb') as fh:
+                for chunk in iter(lambda: fh.read(1 << 20),b''):
+                    h.update(chunk)
+            return h.hexdigest()
+        except (OSError,IOError):
+            return None
+    else:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_mtime,st.st_size]
+
+def load_state(state_file):
+    """
+    Load the record of previous subcommand runs kept in `state_file`.
+    """
+    try:
+        with open(state_file,'r') as fh:
+            return json.load(fh)
+    except (OSError,IOError,ValueError):
+        return {}
+
+def save_state(state_file,state):
+    tmp_fname = '%s.%d.tmp' % (state_file,os.getpid())
+    try:
+        with open(tmp_fname,'w') as fh:
+            json.dump(state,fh)
+        replace_file(tmp_fname,state_file)
+    except Exception:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+# os.rename won't overwrite an existing file on windows
+replace_file = getattr(os,'replace',os.rename)
+
+#################################
+# structured output
+#################################
+OUTPUT_FORMATS = ['jsonl','csv','tsv']
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+def replace_non_finite(value):
+    """
+    Replace NaN and infinite floats in `value` with None.
+    """
+    if isinstance(value,float) and (math.isnan(value) or math.isinf(value)):
+        return None
+    elif isinstance(value,dict):
+        return dict([(k,replace_non_finite(v)) for k,v in value.items()])
+    elif isinstance(value,(list,tuple)):
+        return [replace_non_finite(v) for v in value]
+    else:
+        return value
+
+def encode_json(record):
+    """
+    Encode a record as a single line of JSON, using orjson if it's installed
+    and falling back to json for records orjson can't encode (e.g., integers
+    beyond 64 bits). Either way, non-string dict keys are accepted, non-ASCII
+    text is written as is, NaN and infinity are written as null and values of
+    other types (e.g., datetimes) are written using `str`.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(record,default=str,
+                                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME |
+                                       orjson.OPT_PASSTHROUGH_DATACLASS).decode('utf-8')
+        except TypeError:
+            pass
+
+    try:
+        return json.dumps(record,separators=(',',':'),ensure_ascii=False,allow_nan=False,default=str)
+    except ValueError:
+        return json.dumps(replace_non_finite(record),separators=(',',':'),ensure_ascii=False,default=str)
+
+def encode_py2_record(record):
+    """
+    Encode the text in a record as utf-8, since the python 2 csv module only
+    writes byte strings.
+    """
+    encode = lambda x: x.encode('utf-8') if isinstance(x,text_type) else x
+
+    if isinstance(record,dict):
+        return dict([(encode(k),encode(v)) for k,v in record.items()])
+    else:
+        return [encode(v) for v in record]
+
+def open_output():
+    """
+    Return a stream onto stdout with a large buffer and whether it needs to
+    be closed by the caller.  This is a text stream, except under python 2
+    where it accepts utf-8 byte strings.
+    """
+    try:
+        fileno = sys.stdout.fileno()
+    except (AttributeError,ValueError,io.UnsupportedOperation):
+        # stdout has been replaced by something that isn't a real file
+        return sys.stdout, False
+
+    sys.stdout.flush()
+    if PY2:
+        return io.open(fileno,'wb',buffering=OUTPUT_BUFFER_SIZE,closefd=False), True
+    else:
+        return io.open(fileno,'w',buffering=OUTPUT_BUFFER_SIZE,encoding='utf-8',
+                       newline='',closefd=False), True
+
+def check_record(record):
+    if isinstance(record,(string_types,bytes)):
+        raise TypeError('a record must be a dict or a sequence of values, not a string: %r' % record)
+
+def write_records(records,output_format,out=None):
+    """
+    Write `records` to `out` (by default, a buffered stream onto stdout) in
+    `output_format`, one of `OUTPUT_FORMATS`.
+
+    `records` is either a single record, which must be a dict, or an iterable
+    of records, each of which is a dict or a sequence (e.g., list or tuple) of
+    values. Strings are rejected as both. For csv and tsv, all records must be
+    of the same kind as the first. The columns of dict records are given by
+    the keys of the first record and are written as a header row; later
+    records can omit fields (written as empty) but can't add them.
+
+    If stdout is closed by the reader (e.g., when piped into `head`), writing
+    stops and the process exits. Errors writing to a given `out` are raised.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('output format must be one of %s' % ', '.join(OUTPUT_FORMATS))
+
+    if isinstance(records,dict):
+        records = [records]
+    elif isinstance(records,(string_types,bytes)):
+        raise TypeError('records must be a dict or an iterable of records, not a string')
+
+    close_out = False
+    if out is None:
+        out, close_out = open_output()
+
+    try:
+        if output_format == 'jsonl':
+            for record in records:
+                check_record(record)
+                line = encode_json(record) + '\n'
+                if PY2 and isinstance(line,text_type):
+                    line = line.encode('utf-8')
+                out.write(line)
+        else:
+            delimiter = ',' if output_format == 'csv' else '\t'
+            writer = None
+            fieldnames = None
+            for i,record in enumerate(records):
+                check_record(record)
+                if PY2:
+                    record = encode_py2_record(record)
+
+                if writer is None:
+                    if isinstance(record,dict):
+                        fieldnames = list(record.keys())
+                        writer = csv.DictWriter(out,fieldnames=fieldnames,
+                                                delimiter=delimiter,lineterminator='\n')
+                        writer.writeheader()
+                    else:
+                        writer = csv.writer(out,delimiter=delimiter,lineterminator='\n')
+                elif fieldnames is not None:
+                    if not isinstance(record,dict):
+                        raise TypeError('record %d is a sequence of values but the first record is a dict' % i)
+
+                    extra_fields = [k for k in record if k not in fieldnames]
+                    if len(extra_fields) > 0:
+                        raise ValueError('record %d has fields not in the first record: %s' %
+                                         (i,', '.join([str(k) for k in extra_fields])))
+                elif isinstance(record,dict):
+                    raise TypeError('record %d is a dict but the first record is a sequence of values' % i)
+
+                writer.writerow(record)
+
+        out.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE or not close_out:
+            raise
+
+        # the reader has gone away: send anything still buffered to devnull so
+        # flushing at exit doesn't fail again, then stop
+        devnull = os.open(os.devnull,os.O_WRONLY)
+        os.dup2(devnull,sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        if close_out:
+            try:
+                out.close()
+            except IOError:
+                pass
+
+    return
+
 #################################
 # decorator
 #################################
 registered_subcommands = {}
 registered_subcommands_help = {}
+registered_subcommands_io = {}
 def subcmd(arg=None, **kwargs):
     """
     This decorator is used to register functions as subcommands with instances
     of ArgumentHandler.
+
+    kwargs
+    ------
+      * `help`: the description of the subcommand shown in the help message.
+
+      * `inputs`, `outputs`: the paths the subcommand reads and writes, either
+        as a list or as a function that accepts the parsed arguments and
+        returns a list.  When given, `ArgumentHandler.run` skips the
+        subcommand if none of them have changed since it last ran.
     """
     if inspect.isfunction(arg):
         return subcmd_fxn(arg,arg.__name__, kwargs)
@@ -52,7 +390,7 @@ def subcmd(arg=None, **kwargs):
         return inner_subcmd
 
 def subcmd_fxn(cmd_fxn,name,kwargs):
-    global registered_subcommands, registered_subcommands_help
+    global registered_subcommands, registered_subcommands_help, registered_subcommands_io
 
     # get the name of the command
     if name is None:
@@ -61,15 +399,23 @@ def subcmd_fxn(cmd_fxn,name,kwargs):
     registered_subcommands[name] = cmd_fxn
     registered_subcommands_help[name] = kwargs.pop('help','')
 
+    inputs = kwargs.pop('inputs',None)
+    outputs = kwargs.pop('outputs',None)
+    if inputs is not None or outputs is not None:
+        registered_subcommands_io[name] = (inputs or [],outputs or [])
+    else:
+        registered_subcommands_io.pop(name,None)
+
     return cmd_fxn
 
 def reset_registered_subcommands():
     """
     Forget about all subcommands that have been registered using @subcmd.
     """
-    global registered_subcommands, registered_subcommands_help
+    global registered_subcommands, registered_subcommands_help, registered_subcommands_io
     registered_subcommands = {}
     registered_subcommands_help = {}
+    registered_subcommands_io = {}
 
 #########################
 # ArgumentHandler class
@@ -90,20 +436,64 @@ class ArgumentHandler(argparse.ArgumentParser):
           * `enable_autocompletion [=False]`: make it so that the command line
             supports autocompletion
 
+          * `config_files [=None]`: a list of JSON or TOML config files whose
+            top-level keys are argument destinations. Values found are used as
+            argument defaults. Files that don't exist are skipped and later files
+            take precedence over earlier ones.
+
+          * `env_prefix [=None]`: if given, the environment variable formed by
+            this prefix followed by the upper-cased argument destination (e.g.,
+            `MYTOOL_LOG_LEVEL`) sets the default for that argument. Environment
+            variables take precedence over config files.
+
+          * `config_cache_dir [=None]`: if given, parsed config files are cached
+            in this directory so they aren't re-parsed by later runs. Cached
+            files are unpickled, so the directory must only be writable by the
+            user running the program.
+
+          * `state_file [='.arghandler_state']`: the file in which the inputs and
+            outputs of subcommands that declare them are recorded after they
+            run.
+
+          * `change_detection [='mtime']`: how changes to subcommand inputs and
+            outputs are detected - either 'mtime' (modification time and size)
+            or 'hash' (file contents).
+
+          * `structured_output [=False]`: write the records returned or yielded
+            by subcommands to stdout in the format chosen by a built-in
+            `--output-format` argument (one of jsonl, csv, tsv). If the program
+            defines its own `--output-format`, it is left alone and jsonl is
+            used.
+
         """
 
         ### extract any special keywords here
         self._use_subcommand_help = kwargs.pop('use_subcommand_help', True)
         self._enable_autocompletion = kwargs.pop('enable_autocompletion', False)
+        self._config_files = list(kwargs.pop('config_files', None) or [])
+        self._env_prefix = kwargs.pop('env_prefix', None)
+        self._config_cache_dir = kwargs.pop('config_cache_dir', None)
+        self._state_file = kwargs.pop('state_file', '.arghandler_state')
+        self._change_detection = kwargs.pop('change_detection', 'mtime')
+        self._structured_output = kwargs.pop('structured_output', False)
+
+        if self._change_detection not in ('mtime','hash'):
+            raise ValueError('change_detection must be either "mtime" or "hash"')
 
         # some internal logic management info
         self._logging_argument = None
         self._logging_config_fxn = None
+        self._logging_action = None
         self._ignore_remainder = False
         self._use_subcommands = True
         self._use_registered_subcmds = True
         self._subcommand_lookup = dict()
         self._subcommand_help = dict()
+        self._subcommand_io = dict()
+        self._builtin_actions = []
+        self._force_action = None
+        self._dry_run_action = None
+        self._output_format_action = None
 
         self._has_parsed = False
 
@@ -162,8 +552,8 @@ class ArgumentHandler(argparse.ArgumentParser):
 
         self._logging_config_fxn = config_fxn
 
-        self.add_argument(*names,choices=['DEBUG','INFO','WARNING','ERROR','CRITICAL'],
-                          default=default_level)
+        self._logging_action = self.add_argument(*names,choices=['DEBUG','INFO','WARNING','ERROR','CRITICAL'],
+                                                 default=default_level)
 
         return
 
@@ -178,6 +568,127 @@ class ArgumentHandler(argparse.ArgumentParser):
 
         return argparse.ArgumentParser.add_argument(self,*args,**kwargs)
 
+    def add_config_file(self,path):
+        """
+        Add a config file to the end of the list of config files from which
+        argument defaults are read.  It takes precedence over config files
+        added before it.
+        """
+        self._config_files.append(path)
+
+    def _add_builtin_option(self,name,**kwargs):
+        """
+        Add an option that ArgumentHandler provides itself and return its
+        action.  If the caller already defined an option with the same name or
+        destination, theirs is kept and None is returned.
+        """
+        dest = name.lstrip('-').replace('-','_')
+        if name in self._option_string_actions or dest in [a.dest for a in self._actions]:
+            return None
+
+        action = self.add_argument(name,**kwargs)
+        self._builtin_actions.append(action)
+
+        return action
+
+    def apply_default_sources(self):
+        """
+        Replace argument defaults with values found in config files and
+        environment variables.  The resulting precedence is: command line,
+        environment variable, config file, default given to `add_argument`.
+
+        Only arguments that store a value (including `store_true` and
+        `store_false`) take defaults this way, since other actions such as
+        `count` and `append` add to their default rather than replacing it.
+        Values are checked against the argument's `type` and `choices`.
+        Arguments with `nargs` accept a list, or a string that is split like a
+        shell command line. The options added by ArgumentHandler itself (e.g.,
+        `--dry-run`) always default to their built-in values.
+
+        This is called by `parse_args`.
+        """
+        config = {}
+        for path in self._config_files:
+            contents = load_config_file(path,self._config_cache_dir)
+            if contents is not None:
+                config.update(contents)
+
+        for action in self._actions:
+            if not isinstance(action,(argparse._StoreAction,argparse._StoreTrueAction,argparse._StoreFalseAction)):
+                continue
+
+            if action in self._builtin_actions:
+                continue
+
+            dest = action.dest
+
+            env_name = None
+            if self._env_prefix is not None:
+                env_name = (self._env_prefix + dest).upper()
+
+            if env_name is not None and env_name in os.environ:
+                value = os.environ[env_name]
+                source = 'environment variable %s' % env_name
+            elif dest in config:
+                value = config[dest]
+                source = 'config key %s' % dest
+            else:
+                continue
+
+            action.default = self._convert_default(action,value,source)
+
+        return
+
+    def _convert_default(self,action,value,source):
+        """
+        Convert a value read from `source` into a default for `action`.
+        """
+        if isinstance(action,(argparse._StoreTrueAction,argparse._StoreFalseAction)):
+            if isinstance(value,string_types):
+                if value.lower() in TRUE_STRS:
+                    value = True
+                elif value.lower() in FALSE_STRS:
+                    value = False
+                else:
+                    self.error('%s must be a boolean value, got %r' % (source,value))
+            return value
+
+        if action is self._logging_action:
+            if value in LOG_LEVEL_STR_LOOKUP:
+                value = LOG_LEVEL_STR_LOOKUP[value]
+            elif isinstance(value,string_types):
+                value = value.upper()
+
+        multiple = action.nargs not in (None,argparse.OPTIONAL)
+        if not multiple:
+            values = [value]
+        elif isinstance(value,string_types):
+            values = shlex.split(value)
+        elif isinstance(value,list):
+            values = value
+        else:
+            values = [value]
+
+        converted = []
+        for v in values:
+            if isinstance(v,string_types):
+                try:
+                    v = self._get_value(action,v)
+                except argparse.ArgumentError as e:
+                    self.error('%s: %s' % (source,e))
+
+            if action.choices is not None and v not in action.choices:
+                self.error('%s: invalid choice: %r (choose from %s)' %
+                           (source,v,', '.join([repr(c) for c in action.choices])))
+            converted.append(v)
+
+        if multiple:
+            return converted
+        else:
+            # argparse applies the type to string defaults itself, so only the
+            # validated (not the converted) value is kept
+            return value
+
     def set_subcommands(self, subcommand_lookup, use_registered_subcmds=True):
         """
         Provide a set of subcommands that this instance of ArgumentHandler should
@@ -188,6 +699,10 @@ class ArgumentHandler(argparse.ArgumentParser):
         decorator. To ignore all commands identified by decorator, set
         `use_registered_subcmds` to `False`.  This is a desired behavior when
         using this command, for example, as part of a subcommand.
+
+        A subcommand can be given as a function, a `(function, help)` tuple or
+        a `(function, help, inputs, outputs)` tuple.  See `subcmd` for the
+        meaning of `inputs` and `outputs`.
         """
         if type(subcommand_lookup) is not dict:
             raise TypeError('subcommands must be specified as a dict')
@@ -195,15 +710,20 @@ class ArgumentHandler(argparse.ArgumentParser):
         # sanity check the subcommands
         self._subcommand_lookup = {}
         self._subcommand_help = {}
+        self._subcommand_io = {}
         for cn,cf in subcommand_lookup.items():
             if type(cn) is not str:
                 raise TypeError('subcommand keys must be strings. Found %s' % str(cn))
             if type(cf) == tuple:
                 if not callable(cf[0]):
                     raise TypeError('subcommand with name %s must be callable' % cn)
+                elif len(cf) not in (2,4):
+                    raise TypeError('subcommand with name %s must be a (function, help) or (function, help, inputs, outputs) tuple' % cn)
                 else:
                     self._subcommand_lookup[cn] = cf[0]
                     self._subcommand_help[cn] = cf[1]
+                    if len(cf) == 4:
+                        self._subcommand_io[cn] = (cf[2] or [],cf[3] or [])
             elif not callable(cf):
                 raise TypeError('subcommand with name %s must be callable' % cn)
             else:
@@ -217,7 +737,7 @@ class ArgumentHandler(argparse.ArgumentParser):
         """
         Works the same as `argparse.ArgumentParser.parse_args`.
         """
-        global registered_subcommands, registered_subcommands_help
+        global registered_subcommands, registered_subcommands_help, registered_subcommands_io
 
         if self._has_parsed:
             raise Exception('ArgumentHandler.parse_args can only be called once')
@@ -227,6 +747,8 @@ class ArgumentHandler(argparse.ArgumentParser):
             for cn,cf in registered_subcommands.items():
                 self._subcommand_lookup[cn] = cf
                 self._subcommand_help[cn] = registered_subcommands_help[cn]
+                if cn in registered_subcommands_io:
+                    self._subcommand_io[cn] = registered_subcommands_io[cn]
 
         if len(self._subcommand_lookup) == 0:
             self._use_subcommands = False
@@ -243,10 +765,25 @@ class ArgumentHandler(argparse.ArgumentParser):
                     subcommands_help_text += command.ljust(max_cmd_length+2)
                     subcommands_help_text += self._subcommand_help[command]
                     subcommands_help_text += '\n'
-            self.add_argument('cmd',choices=self._subcommand_lookup.keys(),help=subcommands_help_text,metavar='subcommand')
+            self._builtin_actions.append(
+                self.add_argument('cmd',choices=self._subcommand_lookup.keys(),help=subcommands_help_text,metavar='subcommand'))
 
             cargs_help_msg = 'arguments for the subcommand' if not self._use_subcommand_help else argparse.SUPPRESS
-            self.add_argument('cargs',nargs=argparse.REMAINDER,help=cargs_help_msg)
+            self._builtin_actions.append(self.add_argument('cargs',nargs=argparse.REMAINDER,help=cargs_help_msg))
+
+            if self._structured_output:
+                self._output_format_action = self._add_builtin_option('--output-format',choices=OUTPUT_FORMATS,default='jsonl',
+                                                                      help='the format of records written by the subcommand')
+
+            # subcommands with declared inputs and outputs can be skipped
+            if len(self._subcommand_io) > 0:
+                self._force_action = self._add_builtin_option('--force',action='store_true',
+                                                              help='run the subcommand even if its outputs are up to date')
+                self._dry_run_action = self._add_builtin_option('--dry-run',action='store_true',
+                                                                help='explain whether the subcommand would run, without running it')
+
+        # pull in defaults from config files and the environment
+        self.apply_default_sources()
 
         # handle autocompletion if requested
         if self._enable_autocompletion:
@@ -274,6 +811,18 @@ class ArgumentHandler(argparse.ArgumentParser):
              the `context_fxn` is called.  This function accepts one argument -
              the namespace returned by a call to `parse_args`.
 
+             If the subcommand declared its inputs and outputs, it is skipped
+             (along with `context_fxn`) when none of them have changed since
+             it last ran with the same parsed arguments (including those set
+             from config files and the environment), unless `--force` is
+             given. With `--dry-run`, the decision is printed and nothing is
+             run, whether or not the subcommand declared inputs and outputs.
+             If the program defines its own `--force` or `--dry-run` option,
+             the built-in one isn't available.
+
+             If `structured_output` was enabled, records returned or yielded
+             by the subcommand are written to stdout (see `write_records`).
+
         The parsed arguments are all returned.
         """
         # get the arguments
@@ -289,16 +838,117 @@ class ArgumentHandler(argparse.ArgumentParser):
             # call the logging config fxn
             self._logging_config_fxn(level,args)
 
+        # decide whether the subcommand needs to run
+        run_subcommand = self._use_subcommands
+        io_paths = None
+        if run_subcommand and len(self._subcommand_io) > 0:
+            if args.cmd in self._subcommand_io:
+                io_paths = self._resolve_subcommand_io(args)
+                run_subcommand, reason = self._check_subcommand(args,io_paths)
+            else:
+                reason = 'no inputs or outputs declared'
+
+            if self._dry_run_action is not None and getattr(args,self._dry_run_action.dest):
+                print('%s: %s (%s)' % (args.cmd,'would run' if run_subcommand else 'would skip',reason))
+                return args
+            elif not run_subcommand:
+                logger.info('skipping subcommand %s: %s' % (args.cmd,reason))
+                return args
+
         # generate the context
         context = args
         if context_fxn:
             context = context_fxn(args)
 
-        if self._use_subcommands:
+        if run_subcommand:
             # create the sub command argument parser
             scmd_parser = argparse.ArgumentParser(prog='%s %s' % (self.prog,args.cmd))
 
             # handle the subcommands
-            self._subcommand_lookup[args.cmd](scmd_parser,context,args.cargs)
+            result = self._subcommand_lookup[args.cmd](scmd_parser,context,args.cargs)
+
+            # write out any records the subcommand produced
+            if self._structured_output and result is not None:
+                output_format = 'jsonl'
+                if self._output_format_action is not None:
+                    output_format = getattr(args,self._output_format_action.dest)
+
+                write_records(result,output_format)
+
+            # record what the subcommand ran on
+            if io_paths is not None:
+                self._record_subcommand(args,io_paths)
 
         return args
+
+    def _resolve_subcommand_io(self,args):
+        """
+        Return the lists of input and output paths declared by the subcommand
+        being run.
+        """
+        resolved = []
+        for paths in self._subcommand_io[args.cmd]:
+            if callable(paths):
+                paths = paths(args)
+            if isinstance(paths,string_types) or hasattr(paths,'__fspath__'):
+                paths = [paths]
+
+            # paths may be given as path objects (e.g., pathlib.Path)
+            resolved.append([str(path) for path in paths])
+
+        return tuple(resolved)
+
+    def _state_key(self,args,io_paths):
+        """
+        Return the key under which the last run of this subcommand on these
+        inputs and outputs is recorded, along with a summary of the arguments
+        it was run with.
+        """
+        builtin_dests = [a.dest for a in (self._force_action,self._dry_run_action) if a is not None]
+        arg_values = [(k,v) for k,v in sorted(vars(args).items()) if k not in builtin_dests]
+
+        return (json.dumps([args.cmd,io_paths[0],io_paths[1]]),
+                json.dumps(arg_values,default=str))
+
+    def _check_subcommand(self,args,io_paths):
+        """
+        Return whether the subcommand needs to run and the reason why.
+        """
+        inputs, outputs = io_paths
+
+        if self._force_action is not None and getattr(args,self._force_action.dest):
+            return True, '--force given'
+
+        for path in inputs:
+            if not os.path.exists(path):
+                return True, 'input %s does not exist' % path
+        for path in outputs:
+            if not os.path.exists(path):
+                return True, 'output %s does not exist' % path
+
+        key, arg_values = self._state_key(args,io_paths)
+        previous = load_state(self._state_file).get(key)
+        if previous is None:
+            return True, 'no previous run recorded'
+        elif previous.get('args') != arg_values:
+            return True, 'arguments differ from the last run'
+
+        for kind,paths in (('input',inputs),('output',outputs)):
+            for path in paths:
+                if path_signature(path,self._change_detection) != previous[kind + 's'].get(path):
+                    return True, '%s %s changed' % (kind,path)
+
+        return False, 'inputs and outputs are unchanged since the last run'
+
+    def _record_subcommand(self,args,io_paths):
+        inputs, outputs = io_paths
+
+        # only the latest run on a given set of inputs and outputs is kept
+        key, arg_values = self._state_key(args,io_paths)
+        state = load_state(self._state_file)
+        state[key] = {
+            'args': arg_values,
+            'inputs': dict([(path,path_signature(path,self._change_detection)) for path in inputs]),
+            'outputs': dict([(path,path_signature(path,self._change_detection)) for path in outputs])}
+
+        save_state(self._state_file,state)
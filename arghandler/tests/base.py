@@ -13,11 +13,25 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import os
 import sys
+import json
+import errno
+import shutil
+import datetime
+import tempfile
+import subprocess
 import unittest
 import logging
 import argparse
 from arghandler import *
+import arghandler
+import arghandler.base as arghandler_base
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 import multiprocessing
 
@@ -141,3 +155,374 @@ class ExplicitSubCommandTestCase(unittest.TestCase):
 
         self.assertEqual(len(handler._subcommand_lookup), 1)
         self.assertTrue('cmd2' in handler._subcommand_lookup)
+
+class DefaultSourcesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        reset_registered_subcommands()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir,'cache')
+        self.config_fname = os.path.join(self.tmp_dir,'config.json')
+
+        with open(self.config_fname,'w') as fh:
+            json.dump({'name':'from_config','count':3,'logging':'INFO'},fh)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        for env_name in ['ATEST_NAME','ATEST_LOGGING','ATEST_VERBOSE','ATEST_N','ATEST_FILES','ATEST_V',
+                         'ATEST_PREFIXED','ATEST_DRY_RUN','ATEST_OUTPUT_FORMAT']:
+            os.environ.pop(env_name,None)
+
+    def make_handler(self):
+        handler = ArgumentHandler(config_files=[self.config_fname,'/does/not/exist.json'],
+                                  env_prefix='ATEST_',config_cache_dir=self.cache_dir)
+        handler.add_argument('--name',default='from_default')
+        handler.add_argument('--count',type=int,default=1)
+        handler.add_argument('--other',default='from_default')
+        handler.add_argument('--verbose',action='store_true')
+        handler.set_logging_argument('-L','--logging')
+
+        return handler
+
+    def test_precedence(self):
+        os.environ['ATEST_NAME'] = 'from_env'
+        os.environ['ATEST_VERBOSE'] = 'yes'
+
+        args = self.make_handler().parse_args([])
+        self.assertEqual(args.name,'from_env')
+        self.assertEqual(args.count,3)
+        self.assertEqual(args.other,'from_default')
+        self.assertEqual(args.logging,'INFO')
+        self.assertTrue(args.verbose)
+
+        args = self.make_handler().parse_args(['--name','from_cli','-L','DEBUG'])
+        self.assertEqual(args.name,'from_cli')
+        self.assertEqual(args.logging,'DEBUG')
+
+    def test_logging_level_from_env(self):
+        os.environ['ATEST_LOGGING'] = 'warning'
+
+        args = self.make_handler().parse_args([])
+        self.assertEqual(args.logging,'WARNING')
+
+    def test_cached_config(self):
+        self.make_handler().parse_args([])
+        self.assertEqual(len(os.listdir(self.cache_dir)),1)
+
+        # a changed file must be re-read rather than served from the cache
+        with open(self.config_fname,'w') as fh:
+            json.dump({'name':'changed_config_value'},fh)
+
+        args = self.make_handler().parse_args([])
+        self.assertEqual(args.name,'changed_config_value')
+        self.assertEqual(args.count,1)
+
+    def test_converted_values(self):
+        os.environ['ATEST_N'] = '2'
+        os.environ['ATEST_FILES'] = 'a.txt "b c.txt"'
+
+        handler = self.make_handler()
+        handler.add_argument('--n',type=int,choices=[1,2,3])
+        handler.add_argument('--files',nargs='+')
+
+        args = handler.parse_args([])
+        self.assertEqual(args.n,2)
+        self.assertEqual(args.files,['a.txt','b c.txt'])
+
+    def test_type_applied_once(self):
+        os.environ['ATEST_PREFIXED'] = 'x'
+
+        handler = self.make_handler()
+        handler.add_argument('--prefixed',type=lambda s: 'p/' + s)
+
+        args = handler.parse_args([])
+        self.assertEqual(args.prefixed,'p/x')
+
+    def test_builtin_options_ignored(self):
+        os.environ['ATEST_DRY_RUN'] = '1'
+        os.environ['ATEST_OUTPUT_FORMAT'] = 'csv'
+
+        handler = ArgumentHandler(env_prefix='ATEST_',structured_output=True,
+                                  state_file=os.path.join(self.tmp_dir,'state'))
+        handler.set_subcommands({'cmd1':(lambda parser,context,args: None,'',[],[])})
+
+        args = handler.parse_args(['cmd1'])
+        self.assertFalse(args.dry_run)
+        self.assertEqual(args.output_format,'jsonl')
+
+    def test_unsupported_actions(self):
+        os.environ['ATEST_V'] = '2'
+
+        handler = self.make_handler()
+        handler.add_argument('-v',action='count',default=0)
+
+        args = handler.parse_args(['-v'])
+        self.assertEqual(args.v,1)
+
+class IncrementalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        reset_registered_subcommands()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.in_fname = os.path.join(self.tmp_dir,'in.txt')
+        self.out_fname = os.path.join(self.tmp_dir,'out.txt')
+        self.num_runs = 0
+
+        with open(self.in_fname,'w') as fh:
+            fh.write('hello')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def copy(self,parser,context,args):
+        self.num_runs += 1
+        with open(self.in_fname,'r') as in_fh:
+            with open(self.out_fname,'w') as out_fh:
+                out_fh.write(in_fh.read())
+
+    def no_io(self,parser,context,args):
+        self.num_runs += 1
+
+    def run_handler(self,argv,change_detection='mtime'):
+        handler = ArgumentHandler(state_file=os.path.join(self.tmp_dir,'state'),
+                                  change_detection=change_detection)
+        handler.add_argument('--mode',default='a')
+        handler.set_subcommands({'copy':(self.copy,'copy a file',[self.in_fname],lambda args: [self.out_fname]),
+                                 'no_io':self.no_io})
+        handler.run(argv)
+
+    def test_skip_unchanged(self):
+        self.run_handler(['copy'])
+        self.run_handler(['copy'])
+        self.assertEqual(self.num_runs,1)
+
+        self.run_handler(['--force','copy'])
+        self.assertEqual(self.num_runs,2)
+
+        # different arguments aren't covered by the previous run
+        self.run_handler(['copy','x'])
+        self.assertEqual(self.num_runs,3)
+
+        self.run_handler(['--mode','b','copy','x'])
+        self.assertEqual(self.num_runs,4)
+
+        # only the latest run on the same inputs and outputs is kept
+        with open(os.path.join(self.tmp_dir,'state'),'r') as fh:
+            self.assertEqual(len(json.load(fh)),1)
+
+    def test_rerun_changed(self):
+        self.run_handler(['copy'],'hash')
+
+        with open(self.in_fname,'w') as fh:
+            fh.write('goodbye')
+
+        self.run_handler(['copy'],'hash')
+        self.assertEqual(self.num_runs,2)
+
+        os.remove(self.out_fname)
+        self.run_handler(['copy'],'hash')
+        self.assertEqual(self.num_runs,3)
+
+    def test_dry_run(self):
+        original_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.run_handler(['--dry-run','copy'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = original_stdout
+
+        self.assertEqual(self.num_runs,0)
+        self.assertTrue('would run' in output)
+
+    def test_dry_run_no_io(self):
+        original_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.run_handler(['--dry-run','no_io'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = original_stdout
+
+        self.assertEqual(self.num_runs,0)
+        self.assertTrue('no inputs or outputs declared' in output)
+
+    def test_existing_options(self):
+        handler = ArgumentHandler(state_file=os.path.join(self.tmp_dir,'state'))
+        handler.add_argument('--dry-run',action='store_true')
+        handler.set_subcommands({'copy':(self.copy,'copy a file',[self.in_fname],[self.out_fname])})
+
+        # the program's own --dry-run is left alone, so the subcommand runs
+        handler.run(['--dry-run','copy'])
+        self.assertEqual(self.num_runs,1)
+
+    def test_path_objects(self):
+        try:
+            import pathlib
+        except ImportError:
+            return
+
+        for i in range(2):
+            handler = ArgumentHandler(state_file=os.path.join(self.tmp_dir,'state'))
+            handler.set_subcommands({'copy':(self.copy,'copy a file',pathlib.Path(self.in_fname),
+                                             [pathlib.Path(self.out_fname)])})
+            handler.run(['copy'])
+
+        self.assertEqual(self.num_runs,1)
+        self.assertEqual(os.listdir(self.tmp_dir).count('state'),1)
+        self.assertEqual(len(os.listdir(self.tmp_dir)),3)
+
+    def test_decorator_io(self):
+        @subcmd('copy',inputs=[self.in_fname],outputs=[self.out_fname])
+        def copy(parser,context,args):
+            self.copy(parser,context,args)
+
+        for i in range(2):
+            handler = ArgumentHandler(state_file=os.path.join(self.tmp_dir,'state'))
+            handler.run(['copy'])
+
+        self.assertEqual(self.num_runs,1)
+
+class StructuredOutputTestCase(unittest.TestCase):
+
+    def run_handler(self,argv,cmd,**kwargs):
+        reset_registered_subcommands()
+
+        original_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            handler = ArgumentHandler(**kwargs)
+            handler.set_subcommands({'cmd1':cmd})
+            handler.run(argv)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = original_stdout
+
+        return output
+
+    def test_jsonl(self):
+        def cmd1(parser,context,args):
+            for i in range(2):
+                yield {'i':i,'name':'n%d' % i}
+
+        output = self.run_handler(['cmd1'],cmd1,structured_output=True)
+        self.assertEqual([json.loads(l) for l in output.splitlines()],
+                         [{'i':0,'name':'n0'},{'i':1,'name':'n1'}])
+
+    def test_csv_tsv(self):
+        def cmd1(parser,context,args):
+            return [{'a':1,'b':'x,y'},{'a':2,'b':'z'}]
+
+        output = self.run_handler(['--output-format','csv','cmd1'],cmd1,structured_output=True)
+        self.assertEqual(output,'a,b\n1,"x,y"\n2,z\n')
+
+        def cmd2(parser,context,args):
+            return [(1,'x'),(2,'y')]
+
+        output = self.run_handler(['--output-format','tsv','cmd1'],cmd2,structured_output=True)
+        self.assertEqual(output,'1\tx\n2\ty\n')
+
+    def test_disabled(self):
+        def cmd1(parser,context,args):
+            return {'a':1}
+
+        self.assertEqual(self.run_handler(['cmd1'],cmd1),'')
+
+    def test_single_records(self):
+        def cmd1(parser,context,args):
+            return {'a':1}
+
+        output = self.run_handler(['cmd1'],cmd1,structured_output=True)
+        self.assertEqual(json.loads(output),{'a':1})
+
+        def cmd2(parser,context,args):
+            return 'a,b'
+
+        self.assertRaises(TypeError,self.run_handler,['cmd1'],cmd2,structured_output=True)
+
+        def cmd3(parser,context,args):
+            return ['a',1]
+
+        self.assertRaises(TypeError,self.run_handler,['cmd1'],cmd3,structured_output=True)
+
+    def test_json_encoders_match(self):
+        records = [{1:u'caf\u00e9'},
+                   {'big':2**70,'nested':[1.5,{'x':None}]},
+                   {'nan':float('nan'),'inf':[float('inf')]},
+                   {'when':datetime.datetime(2020,1,2,3,4,5)},
+                   (True,'a',2)]
+        encoded = [arghandler_base.encode_json(r) for r in records]
+
+        orjson = arghandler_base.orjson
+        arghandler_base.orjson = None
+        try:
+            self.assertEqual([arghandler_base.encode_json(r) for r in records],encoded)
+        finally:
+            arghandler_base.orjson = orjson
+
+        self.assertEqual([json.loads(e) for e in encoded],
+                         [{'1':u'caf\u00e9'},
+                          {'big':2**70,'nested':[1.5,{'x':None}]},
+                          {'nan':None,'inf':[None]},
+                          {'when':'2020-01-02 03:04:05'},
+                          [True,'a',2]])
+
+    def test_mismatched_csv_records(self):
+        out = StringIO()
+        self.assertRaises(ValueError,arghandler_base.write_records,[{'a':1},{'a':2,'b':3}],'csv',out)
+        self.assertRaises(TypeError,arghandler_base.write_records,[{'a':1},[2]],'csv',out)
+        self.assertRaises(TypeError,arghandler_base.write_records,[[1],{'a':2}],'tsv',out)
+
+        out = StringIO()
+        arghandler_base.write_records([{'a':1,'b':2},{'b':3}],'csv',out)
+        self.assertEqual(out.getvalue(),'a,b\n1,2\n,3\n')
+
+    def test_broken_given_stream(self):
+        class ClosedPipe(object):
+            def write(self,s):
+                raise IOError(errno.EPIPE,'Broken pipe')
+
+        self.assertRaises(IOError,arghandler_base.write_records,[{'a':1}],'jsonl',ClosedPipe())
+
+    def test_existing_output_format(self):
+        def cmd1(parser,context,args):
+            return {'a':1}
+
+        reset_registered_subcommands()
+
+        original_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            handler = ArgumentHandler(structured_output=True)
+            handler.add_argument('--output-format',default='text')
+            handler.set_subcommands({'cmd1':cmd1})
+            args = handler.run(['--output-format','yaml','cmd1'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = original_stdout
+
+        self.assertEqual(args.output_format,'yaml')
+        self.assertEqual(json.loads(output),{'a':1})
+
+    def test_broken_pipe(self):
+        script = '\n'.join(['from arghandler import *',
+                            'def cmd1(parser,context,args):',
+                            '    for i in range(1000000):',
+                            '        yield {"i":i}',
+                            'handler = ArgumentHandler(structured_output=True)',
+                            'handler.set_subcommands({"cmd1":cmd1})',
+                            'handler.run(["cmd1"])'])
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(arghandler.__file__)))
+
+        p = subprocess.Popen([sys.executable,'-c',script],env=env,
+                             stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        first_line = p.stdout.readline()
+        p.stdout.close()
+        err = p.stderr.read()
+        p.stderr.close()
+        p.wait()
+
+        self.assertEqual(json.loads(first_line.decode('utf-8')),{'i':0})
+        self.assertFalse(b'Traceback' in err)
@@ -17,6 +17,7 @@ setup(  name='arghandler',
         packages=['arghandler','arghandler.tests'],
 
         install_requires=['argcomplete'],
+        extras_require={'fast_json': ['orjson']},
 
         license='Apache',
 